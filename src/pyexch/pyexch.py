@@ -1,22 +1,34 @@
 import collections
+import concurrent.futures
 import datetime
 import exchangelib
 import exchangelib.errors
+import functools
 import getpass
+import itertools
 import json
 import logging
 import netrc
 import oauthlib
 import os
 import pathlib
-import pprint
 import re
 import requests_oauthlib
 import sys
+import tempfile
+import time
 import yaml
 
 LOGR = logging.getLogger(__name__)
 
+# exchangelib Configurations (credentials + HTTP session pool),
+# keyed by ( server, tenant_id, client_id, token_file )
+_CONFIG_CACHE = {}
+
+# logged in exchangelib Accounts,
+# keyed by ( account, tenant_id, client_id, token_file )
+_ACCOUNT_CACHE = {}
+
 simple_event = collections.namedtuple( 'SimpleEvent', [
     "start",
     "end",
@@ -28,6 +40,81 @@ simple_event = collections.namedtuple( 'SimpleEvent', [
     "raw_event" ] )
 
 
+# regex constructs that depend on their position or group numbering within the
+# whole pattern (inline flags, named groups, conditionals, comments and
+# backreferences), so can't be joined into a combined alternation
+_UNSAFE_TO_JOIN = re.compile( r'\(\?(?![:=!]|<[=!])|\\\d' )
+
+
+@functools.lru_cache( maxsize=256 )
+def _compile( pattern, flags=re.IGNORECASE ):
+    ''' Process-wide cache of compiled patterns, shared by all PyExch instances.
+        Compiled Pattern objects are immutable, so sharing them is safe.
+    '''
+    return re.compile( pattern, flags )
+
+
+def _required_keywords( regex_map ):
+    ''' Return a tuple of lowercase literal strings such that any subject
+        matched by one of the regexes in regex_map contains at least one of them,
+        or None if that cannot be worked out from the patterns.
+        Only simple patterns are understood: an optional outer group around
+        "|" separated alternatives made of literal text, "^", "$" and ".".
+    '''
+    keywords = set()
+    for pattern in regex_map.values():
+        if pattern.startswith( '(' ) and pattern.endswith( ')' ):
+            pattern = pattern[1:-1]
+        if any( c in pattern for c in '()[]{}*+?\\' ):
+            return None
+        for alt in pattern.split( '|' ):
+            if alt.startswith( '^' ):
+                alt = alt[1:]
+            if alt.endswith( '$' ):
+                alt = alt[:-1]
+            if '^' in alt or '$' in alt:
+                return None
+            # every run of literal text between "." wildcards is required
+            longest = max( alt.split( '.' ), key=len )
+            if not longest:
+                return None
+            keywords.add( longest.lower() )
+    return tuple( sorted( keywords ) )
+
+
+@functools.lru_cache( maxsize=8 )
+def _load_netrc_cached( path, mtime_ns ):
+    ''' Parsed netrc file, cached until the file's mtime changes.
+        path=None reads the default ~/.netrc, for which netrc also checks
+        the file's ownership and permissions.
+    '''
+    return netrc.netrc( path )
+
+
+@functools.lru_cache( maxsize=8 )
+def _load_yaml_cached( path, mtime_ns ):
+    ''' Parsed YAML file, cached until the file's mtime changes.
+        Callers must not modify the returned object.
+    '''
+    return yaml.safe_load( pathlib.Path( path ).read_text() )
+
+
+@functools.lru_cache( maxsize=8 )
+def _read_token_file( path, mtime_ns ):
+    ''' Parsed JSON token file, cached until the file's mtime changes.
+        Callers must not modify the returned object.
+    '''
+    with open( path ) as f:
+        return json.load( f )
+
+
+@functools.lru_cache( maxsize=1 )
+def _local_ews_tz():
+    ''' Local timezone, looked up once per process.
+    '''
+    return exchangelib.EWSTimeZone.localzone()
+
+
 class PyExch( object ):
     ''' Get calendar events from Exchange, convert to hours (worked, sick,
         vacation, etc.) per day.
@@ -36,8 +123,23 @@ class PyExch( object ):
     oauth_config_file_default = f"{os.environ['HOME']}/.ssh/exchange_oauth.yaml"
     token_file_default = f"{os.environ['HOME']}/.ssh/exchange_token"
 
+    # calendar item fields fetched by get_events_filtered
+    # (everything else on raw_event is left unloaded); exchangelib needs the
+    # start/end timezones to work out the dates of all-day events
+    event_fields = (
+        'subject', 'start', 'end', 'is_all_day', '_start_timezone', '_end_timezone' )
+    # fields that EWS will not return from the calendar view itself (exchangelib
+    # "complex" fields); these are fetched afterwards, only for matching events,
+    # in batches of detail_chunk_size
+    detail_fields = ( 'location', )
+    detail_chunk_size = 100
+    # date ranges longer than view_chunk_days are split into sub-ranges of
+    # that size, fetched concurrently by up to view_max_workers threads
+    view_chunk_days = 30
+    view_max_workers = 4
 
-    def __init__( self, oauth_conf={}, account=None, regex_map=None ):
+
+    def __init__( self, oauth_conf={}, account=None, regex_map=None, tz=None ):
         ''' + oauth_conf (Dict) with keys:
               - tenant_id (String)
               - client_id (String)
@@ -49,6 +151,10 @@ class PyExch( object ):
               If subject (of exchange event) matches <REGEX>, then a new
               simple_event is created with type=KEY.
               If subject does not match any <REGEX>, then exchange event is ignored.
+              If subject matches more than one <REGEX>, only the earliest match
+              in the subject is used (ties go to the first KEY in regex_map).
+            + tz (tzinfo) timezone for naive datetimes and for the times in
+              simple_events (default: the local timezone)
             ---------------------
             ENVIRONMENT VARIABLES
             ---------------------
@@ -65,19 +171,80 @@ class PyExch( object ):
         self.exch_account = None
         if not self.regex_map:
             raise UserWarning( 'Cannot proceed with null regex_map' )
-        self.re_map = { k: re.compile( v, re.IGNORECASE ) for k,v in self.regex_map.items() }
-        self.tz = exchangelib.EWSTimeZone.localzone()
-        self.credentials = exchangelib.OAuth2AuthorizationCodeCredentials(
-            client_id=self.oauth_conf['client_id'],
-            client_secret=self.oauth_conf['client_secret'],
-            tenant_id=self.oauth_conf['tenant_id'],
-            access_token=self._get_token(),
-        )
-        ews_config = exchangelib.Configuration(
-            server='outlook.office365.com',
-            credentials=self.credentials,
-            auth_type=exchangelib.OAUTH2,
-        )
+        self.re_map = { k: _compile( v ) for k,v in self.regex_map.items() }
+        # When possible, all classes are fused into one alternation of named
+        # groups, so that get_events_filtered scans each subject once instead
+        # of once per class. Patterns with inline flags, named groups,
+        # conditionals or backreferences can't be embedded in a larger pattern;
+        # if there are any, _combined_re is None and re_map is used one by one.
+        self._combined_re = None
+        self._match_lowercase = False
+        if not any( _UNSAFE_TO_JOIN.search( v ) for v in self.regex_map.values() ):
+            # KEYs need not be valid group names, so groups are named _0, _1, ...
+            # and mapped back to their KEY via _group_types
+            self._group_types = { f'_{i}': k for i, k in enumerate( self.regex_map ) }
+            # Matching lowercase patterns case-sensitively against the lowercased
+            # subject is faster than IGNORECASE, but lowercasing escapes
+            # (\D, \x4A) or character class ranges ([A-z], [Z-a]) changes
+            # their meaning, so keep IGNORECASE for those.
+            self._match_lowercase = not any(
+                '\\' in v or '[' in v for v in self.regex_map.values() )
+            if self._match_lowercase:
+                self._combined_re = _compile(
+                    '|'.join( f'(?P<_{i}>{v.lower()})' for i, v in enumerate( self.regex_map.values() ) ),
+                    0 )
+            else:
+                self._combined_re = _compile(
+                    '|'.join( f'(?P<_{i}>{v})' for i, v in enumerate( self.regex_map.values() ) ) )
+        # cheap substring test to skip the regex for most subjects
+        self._subject_keywords = _required_keywords( self.regex_map )
+        if tz is None:
+            self.tz = _local_ews_tz()
+        else:
+            self.tz = exchangelib.EWSTimeZone.from_timezone( tz )
+        # reuse an already authenticated Account (and its HTTP session pool)
+        # rather than fetching a token and logging in again.
+        # The token file identifies which user authorized the oauth client, so
+        # different users of the same client don't share one another's login
+        token_path = os.path.realpath( self.token_file )
+        cache_key = (
+            self.account,
+            self.oauth_conf['tenant_id'],
+            self.oauth_conf['client_id'],
+            token_path,
+            )
+        self.exch_account = _ACCOUNT_CACHE.get( cache_key )
+        if self.exch_account:
+            LOGR.debug( 'reusing Exchange account for %s', self.account )
+            self.credentials = self.exch_account.protocol.credentials
+            return
+        # other accounts reached with the same oauth client (e.g. shared
+        # calendars) reuse the Configuration, so the token is only fetched once
+        # and exchangelib shares one protocol and session pool between them
+        server = 'outlook.office365.com'
+        config_key = (
+            server,
+            self.oauth_conf['tenant_id'],
+            self.oauth_conf['client_id'],
+            token_path,
+            )
+        ews_config = _CONFIG_CACHE.get( config_key )
+        if ews_config:
+            self.credentials = ews_config.credentials
+        else:
+            self.credentials = exchangelib.OAuth2AuthorizationCodeCredentials(
+                client_id=self.oauth_conf['client_id'],
+                client_secret=self.oauth_conf['client_secret'],
+                tenant_id=self.oauth_conf['tenant_id'],
+                access_token=self._get_token(),
+            )
+            ews_config = exchangelib.Configuration(
+                server=server,
+                credentials=self.credentials,
+                auth_type=exchangelib.OAUTH2,
+                max_connections=self.view_max_workers,
+            )
+            _CONFIG_CACHE[ config_key ] = ews_config
         acct_parms_ews = {
             'primary_smtp_address': self.account,
             'access_type': exchangelib.DELEGATE,
@@ -87,12 +254,15 @@ class PyExch( object ):
         self.exch_account = exchangelib.Account( **acct_parms_ews )
         if not self.exch_account:
             raise UserWarning( 'Error while logging into Exchange Cloud Service' )
+        _ACCOUNT_CACHE[ cache_key ] = self.exch_account
 
 
     def _try_load_from_env( self ):
         # attempt to load NETRC
         netrc_file = os.getenv( 'NETRC' )
-        nrc = netrc.netrc( netrc_file )
+        mtime_ns = os.stat(
+            netrc_file or os.path.join( os.path.expanduser( '~' ), '.netrc' ) ).st_mtime_ns
+        nrc = _load_netrc_cached( netrc_file, mtime_ns )
         nrc_parts = nrc.authenticators( 'EXCH' )
         if nrc_parts:
             if not self.account:
@@ -105,8 +275,8 @@ class PyExch( object ):
         # OAUTH CONFIG
         if not self.oauth_conf:
             oauth_config_file = os.getenv( 'OAUTH_CONFIG_FILE', self.oauth_config_file_default )
-            p = pathlib.Path( oauth_config_file )
-            self.oauth_conf = yaml.safe_load( p.read_text() )
+            mtime_ns = os.stat( oauth_config_file ).st_mtime_ns
+            self.oauth_conf = dict( _load_yaml_cached( oauth_config_file, mtime_ns ) )
         # OAUTH TOKEN FILE
         if not self.token_file:
             self.token_file = os.getenv( 'OAUTH_TOKEN_FILE', self.token_file_default )
@@ -115,26 +285,70 @@ class PyExch( object ):
     def _get_token( self ):
         p = pathlib.Path( self.token_file )
         if p.is_file():
-            with p.open() as f:
-                token = json.load( f )
+            token = dict( _read_token_file( self.token_file, p.stat().st_mtime_ns ) )
             if self._is_token_expired( token ):
                 # exchangelib can't (or doesn't know how to) refresh an expired token
-                # so just force a new one from scratch
-                LOGR.info( 'token is expired, get a new auth code' )
-                token = self._new_token_from_auth_code()
+                # so do it here, before handing the token to exchangelib
+                token = self._refresh_token( token )
         else:
             LOGR.info( 'token file NOT FOUND, get a new auth code' )
             token = self._new_token_from_auth_code()
-        LOGR.debug( f"Token:\n{token}" )
+        LOGR.debug( 'Token:\n%s', token )
+        return token
+
+
+    def _oauth_base_url( self ):
+        tenant_id = self.oauth_conf['tenant_id']
+        return f'https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0'
+
+
+    def _save_token( self, token ):
+        # write to a temp file and rename it into place, so that readers never
+        # see a partially written file (and the mtime based cache stays valid)
+        p = pathlib.Path( self.token_file )
+        with tempfile.NamedTemporaryFile(
+                mode='w', dir=p.parent, prefix=f'.{p.name}.', delete=False ) as f:
+            try:
+                json.dump( token, f )
+                f.close()
+                os.replace( f.name, p )
+            except BaseException:
+                # don't leave the temp file behind
+                f.close()
+                os.unlink( f.name )
+                raise
+
+
+    def _refresh_token( self, token ):
+        ''' Get a new token, without user interaction, using the refresh_token
+            of an expired token.
+            Fall back to a new auth code if there is no refresh_token
+            (requires 'offline_access' in scope) or the refresh is rejected.
+        '''
+        if 'refresh_token' not in token:
+            LOGR.info( 'token is expired, get a new auth code' )
+            return self._new_token_from_auth_code()
+        LOGR.info( 'token is expired, refreshing' )
+        oa2session = requests_oauthlib.OAuth2Session(
+            self.oauth_conf['client_id'],
+            scope=self.oauth_conf['scope'],
+            )
+        try:
+            token = oa2session.refresh_token(
+                f'{self._oauth_base_url()}/token',
+                refresh_token=token['refresh_token'],
+                client_id=self.oauth_conf['client_id'],
+                client_secret=self.oauth_conf['client_secret'],
+                )
+        except oauthlib.oauth2.rfc6749.errors.OAuth2Error as e:
+            LOGR.info( 'token refresh failed (%s), get a new auth code', e )
+            return self._new_token_from_auth_code()
+        self._save_token( token )
         return token
 
 
     def _new_token_from_auth_code( self ):
-        base_url = ''.join((
-            'https://login.microsoftonline.com/',
-            self.oauth_conf['tenant_id'],
-            '/oauth2/v2.0',
-            ))
+        base_url = self._oauth_base_url()
         auth_url = f'{base_url}/authorize'
         token_url = f'{base_url}/token'
         redirect_url = 'https://login.microsoftonline.com/common/oauth2/nativeclient'
@@ -153,81 +367,218 @@ class PyExch( object ):
             authorization_response=response,
             include_client_id=True
             )
-        p = pathlib.Path( self.token_file )
-        with p.open( mode='w' ) as f:
-            json.dump( token, f )
+        self._save_token( token )
         return token
 
 
     def _is_token_expired( self, token ):
-        expiration = datetime.datetime.fromtimestamp( token['expires_at'] )
-        LOGR.debug( f'token expires at: {expiration}' )
-        now = datetime.datetime.now()
-        return now >= expiration
+        expiration = float( token['expires_at'] )
+        LOGR.debug( 'token expires at: %s', expiration )
+        # treat the token as expired a minute early, so it doesn't expire
+        # part way through a request
+        return time.time() >= expiration - 60
+
+
+    def _to_ews( self, dt ):
+        ''' Convert a Python datetime to a timezone aware EWSDateTime.
+            Naive datetimes are taken as wall clock times in self.tz.
+        '''
+        if dt.tzinfo:
+            return exchangelib.EWSDateTime.from_datetime( dt )
+        return exchangelib.EWSDateTime.from_datetime( dt.replace( tzinfo=self.tz ) )
 
 
     def get_events_filtered( self, start, end=None ):
-        LOGR.debug( 'Enter get_events_filtered' )
-        calendar_events = []
-        cal_start = exchangelib.EWSDateTime.from_datetime( start )
-        if not start.tzinfo:
-            cal_start = exchangelib.EWSDateTime.from_datetime( start ).astimezone( self.tz )
-        LOGR.debug( pprint.pformat( f'Cal_Start: {cal_start}' ) )
-        cal_end = exchangelib.EWSDateTime.now().astimezone( self.tz ) #default
+        ''' Return a list of simple_events between start and end (default: now)
+            whose subject matches a regex in regex_map
+        '''
+        return list( self.iter_events_filtered( start, end ) )
+
+
+    def iter_events_filtered( self, start, end=None ):
+        ''' Same as get_events_filtered, but yield simple_events as they are
+            received from Exchange instead of building a list
+        '''
+        LOGR.debug( 'Enter iter_events_filtered' )
+        cal_start = self._to_ews( start )
+        LOGR.debug( 'Cal_Start: %s', cal_start )
         if end:
-            #override default
-            cal_end = exchangelib.EWSDateTime.from_datetime( end )
-            if not end.tzinfo:
-                cal_end = exchangelib.EWSDateTime.from_datetime( end ).astimezone( self.tz )
-        LOGR.debug( pprint.pformat( f'Cal_End: {cal_end}' ) )
-        items = self.exch_account.calendar.view( start=cal_start, end=cal_end )
+            cal_end = self._to_ews( end )
+        else:
+            cal_end = exchangelib.EWSDateTime.now().astimezone( self.tz ) #default
+        LOGR.debug( 'Cal_End: %s', cal_end )
+        items = self._iter_calendar_view( cal_start, cal_end )
+        keywords = self._subject_keywords
+        match_lowercase = self._match_lowercase
+        combined_re = self._combined_re
+        if combined_re is not None:
+            search = combined_re.search
+            group_types = self._group_types
+        else:
+            re_items = tuple( self.re_map.items() )
+        chunk_size = self.detail_chunk_size
+        matched = []
+        append = matched.append
         for item in items:
-            for typ,regx in self.re_map.items():
-                if regx.search( item.subject ):
-                    calendar_events.append( self.as_simple_event( item, typ ) )
-        return calendar_events
+            subject = item.subject.lower()
+            if keywords is not None and not any( k in subject for k in keywords ):
+                continue
+            if combined_re is not None:
+                m = search( subject if match_lowercase else item.subject )
+                typ = group_types[ m.lastgroup ] if m else None
+            else:
+                # same rule as the alternation: earliest match in the subject,
+                # ties go to the first KEY
+                typ = None
+                for k, regx in re_items:
+                    m = regx.search( item.subject )
+                    if m and ( typ is None or m.start() < first ):
+                        typ, first = k, m.start()
+            if typ is not None:
+                append( ( item, typ ) )
+                if len( matched ) >= chunk_size:
+                    yield from self._fetch_details( matched )
+                    matched.clear()
+        yield from self._fetch_details( matched )
 
 
-    def as_simple_event( self, event, typ ):
+    def _calendar_view( self, cal_start, cal_end ):
+        # Subjects are filtered client-side; EWS does not allow combining a
+        # CalendarView (needed to unfold recurring events) with a search
+        # restriction, so a server-side Q(subject__icontains=...) is not an option.
+        return self.exch_account.calendar.view(
+            start=cal_start,
+            end=cal_end ).only( *self.event_fields )
+
+
+    def _iter_calendar_view( self, cal_start, cal_end ):
+        ''' Yield calendar items between cal_start and cal_end.
+            Long ranges are split into view_chunk_days sub-ranges which are
+            fetched concurrently; items are yielded in sub-range order.
+        '''
+        step = datetime.timedelta( days=self.view_chunk_days )
+        bounds = [ cal_start ]
+        while bounds[-1] + step < cal_end:
+            bounds.append( bounds[-1] + step )
+        bounds.append( cal_end )
+        ranges = list( zip( bounds[:-1], bounds[1:] ) )
+        if len( ranges ) == 1:
+            yield from self._calendar_view( cal_start, cal_end )
+            return
+        def fetch( lo, hi ):
+            return list( self._calendar_view( lo, hi ) )
+        pool = concurrent.futures.ThreadPoolExecutor( max_workers=self.view_max_workers )
         try:
-            start = event.start.astimezone( self.tz )
-            end = event.end.astimezone( self.tz )
-        except AttributeError as e:
+            # keep at most view_max_workers sub-ranges in flight, so results
+            # aren't all held in memory when the consumer is slower than EWS
+            todo = iter( ranges )
+            pending = collections.deque(
+                ( hi, pool.submit( fetch, lo, hi ) )
+                for lo, hi in itertools.islice( todo, self.view_max_workers ) )
+            # An event overlapping a sub-range boundary is returned for each
+            # sub-range it overlaps; skip ids already yielded by the previous
+            # sub-range. Only ids of events that may reach past a boundary
+            # (with two days of slack for timezones) need to be carried over.
+            carry = set()
+            while pending:
+                hi, future = pending.popleft()
+                items = future.result()
+                r = next( todo, None )
+                if r:
+                    pending.append( ( r[1], pool.submit( fetch, *r ) ) )
+                near_hi = ( hi - datetime.timedelta( days=2 ) ).date()
+                next_carry = set()
+                for item in items:
+                    end = item.end
+                    if isinstance( end, datetime.datetime ):
+                        end = end.date()
+                    if end >= near_hi:
+                        next_carry.add( item.id )
+                    if item.id in carry:
+                        continue
+                    yield item
+                carry = next_carry
+        finally:
+            pool.shutdown( wait=False, cancel_futures=True )
+
+
+    def _fetch_details( self, matched ):
+        ''' Fetch detail_fields for a list of ( item, type ) tuples
+            and yield the corresponding simple_events
+        '''
+        if not matched:
+            return
+        if not self.detail_fields:
+            details = ( item for item, typ in matched )
+        else:
+            details = self.exch_account.fetch(
+                ids=[ item for item, typ in matched ],
+                folder=self.exch_account.calendar,
+                only_fields=self.event_fields + self.detail_fields )
+        for ( item, typ ), detail in zip( matched, details ):
+            if isinstance( detail, exchangelib.errors.ErrorItemNotFound ):
+                # item was deleted since the calendar view was fetched
+                LOGR.debug( 'skipping %s: %s', item.subject, detail )
+                continue
+            if isinstance( detail, Exception ):
+                raise detail
+            yield self.as_simple_event( detail, typ )
+
+
+    def as_simple_event( self, event, typ ):
+        tz = self.tz
+        ev_start = event.start
+        ev_end = event.end
+        if isinstance( ev_start, datetime.datetime ):
+            # elapsed is timezone invariant, take it from the values as received
+            elapsed = ev_end - ev_start
+            start = ev_start.astimezone( tz )
+            end = ev_end.astimezone( tz )
+        else:
             # convert EWSDate to EWSDateTime (common for all-day events)
-            sy, sm, sd = [ getattr( event.start, a ) for a in ( 'year', 'month', 'day' ) ]
-            ey, em, ed = [ getattr( event.end, a ) for a in ( 'year', 'month', 'day' ) ]
-            start = exchangelib.EWSDateTime( sy, sm, sd, tzinfo=self.tz )
-            end = exchangelib.EWSDateTime( ey, em, ed, 23, 59, 59, tzinfo=self.tz )
-        elapsed = end - start
+            start = exchangelib.EWSDateTime( ev_start.year, ev_start.month, ev_start.day, tzinfo=tz )
+            end = exchangelib.EWSDateTime( ev_end.year, ev_end.month, ev_end.day, 23, 59, 59, tzinfo=tz )
+            elapsed = end - start
+        # positional args, in simple_event field order (faster than keywords)
         return simple_event(
-            start=start,
-            end=end,
-            elapsed=elapsed,
-            is_all_day=event.is_all_day,
-            type=typ,
-            location=event.location,
-            subject=event.subject,
-            raw_event=event )
+            start,
+            end,
+            elapsed,
+            event.is_all_day,
+            typ,
+            event.location,
+            event.subject,
+            event )
 
 
     def event_to_daily_data( self, e ):
-        elapsed = int( e.elapsed.total_seconds() )
-        daily_secs = []
-        dayone_secs = elapsed
-        if elapsed > 86400:
-            # num seconds from start time of event to end of day
-            dayone_secs = 86400 - ( e.start.hour * 3600 ) - ( e.start.minute * 60 ) - e.start.second
-        daily_secs.append( dayone_secs )
-        elapsed = elapsed - dayone_secs
-        while elapsed > 0:
-            daily_secs.append( min( 86400, elapsed ) )
-            elapsed = elapsed - 86400
-        daily_data = {}
-        for i in range( len( daily_secs ) ):
-            diff = datetime.timedelta( days=i )
-            thedate = ( e.start + diff ).date()
-            daily_data[ thedate ] = { e.type: daily_secs[i] }
-        return daily_data
+        return { d: { e.type: secs } for d, secs in self._iter_daily_secs( e ) }
+
+
+    def _iter_daily_secs( self, e ):
+        ''' Yield ( date, seconds ) for each day spanned by simple_event e
+        '''
+        start = e.start
+        # Days are split on the wall clock, so use the wall clock duration
+        # rather than e.elapsed: start and end share a tzinfo, so subtracting
+        # them ignores DST changes in between (which e.elapsed includes)
+        wall = e.end - start
+        # whole seconds, without the float round trip of total_seconds()
+        elapsed = wall.days * 86400 + wall.seconds
+        base_ord = start.toordinal()
+        fromordinal = exchangelib.EWSDate.fromordinal
+        if elapsed <= 86400:
+            yield ( fromordinal( base_ord ), elapsed )
+            return
+        # num seconds from start time of event to end of day
+        dayone_secs = 86400 - ( start.hour * 3600 ) - ( start.minute * 60 ) - start.second
+        yield ( fromordinal( base_ord ), dayone_secs )
+        # remaining seconds fill whole days, plus a partial last day
+        full_days, lastday_secs = divmod( elapsed - dayone_secs, 86400 )
+        for i in range( 1, full_days + 1 ):
+            yield ( fromordinal( base_ord + i ), 86400 )
+        if lastday_secs:
+            yield ( fromordinal( base_ord + full_days + 1 ), lastday_secs )
 
 
     def per_day_report( self, start, end=None ):
@@ -235,19 +586,17 @@ class PyExch( object ):
             regex CLASS to seconds spent in that class
             where "CLASS" is a KEY from regex_map (passed to init)
         '''
-        raw_events = self.get_events_filtered( start, end )
-        dates = {}
+        raw_events = self.iter_events_filtered( start, end )
+        dates = collections.defaultdict( collections.Counter )
+        iter_daily_secs = self._iter_daily_secs
+        debug = LOGR.isEnabledFor( logging.DEBUG )
         for e in raw_events:
-            daily_data = self.event_to_daily_data( e )
-            LOGR.debug( daily_data )
-            for thedate, data in daily_data.items():
-                if thedate not in dates:
-                    dates[ thedate ] = {}
-                for ev_type, secs in data.items():
-                    if ev_type not in dates[ thedate ]:
-                        dates[ thedate ][ ev_type ] = 0
-                    dates[ thedate ][ ev_type ] += secs
-        return dates
+            ev_type = e.type
+            for thedate, secs in iter_daily_secs( e ):
+                if debug:
+                    LOGR.debug( '%s %s %s', thedate, ev_type, secs )
+                dates[ thedate ][ ev_type ] += secs
+        return dict( dates )
 
 
     def new_event( self, start, end, subject, attendees, location, is_all_day=False, categories=None, free=False ):
@@ -261,12 +610,8 @@ class PyExch( object ):
             free = Boolean, if true, event will not block the calendar
         '''
         # convert start and end to timezone aware EWSDateTime's
-        cal_start = exchangelib.EWSDateTime.from_datetime( start )
-        if not start.tzinfo:
-            cal_start = exchangelib.EWSDateTime.from_datetime( start ).astimezone( self.tz )
-        cal_end = exchangelib.EWSDateTime.from_datetime( end )
-        if not end.tzinfo:
-            cal_end = exchangelib.EWSDateTime.from_datetime( end ).astimezone( self.tz )
+        cal_start = self._to_ews( start )
+        cal_end = self._to_ews( end )
         params = {
             'account': self.exch_account,
             'folder': self.exch_account.calendar,
@@ -330,7 +675,13 @@ class PyExch( object ):
             update_fields.append( 'categories' )
             event.categories = categories
             update_recipients = exchangelib.items.SEND_ONLY_TO_ALL
-        event.save( send_meeting_invitations=update_recipients )
+        if not update_fields:
+            return event
+        # only save the changed fields; event may have been fetched with
+        # a subset of fields (see detail_fields) and a full save would clear the rest
+        event.save(
+            update_fields=update_fields,
+            send_meeting_invitations=update_recipients )
         return event
 
 